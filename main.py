@@ -1,115 +1,268 @@
+import asyncio
+import hashlib
 import logging
-import shutil
+import os
 import uuid
 from contextlib import asynccontextmanager
 from pathlib import Path
-from pprint import pprint
-from typing import List
-
-from fastapi import Depends, FastAPI, File, Form, HTTPException, UploadFile
+from typing import List, Optional
+
+import aiofiles
+from async_lru import alru_cache
+from fastapi import (BackgroundTasks, Depends, FastAPI, File, Form,
+                     HTTPException, Query, Request, Response, UploadFile)
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import ORJSONResponse
 from fastapi.staticfiles import StaticFiles
-from PIL import Image
-from sqlalchemy.orm import Session, aliased
+from filelock import FileLock
+from PIL import Image, ImageOps
+from pydantic import TypeAdapter
+from sqlalchemy import delete, insert, select, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import aliased, joinedload, load_only, selectinload
 from sqlalchemy.sql import func, text
 
-from models import (Item, SessionLocal, Tag, fill_states, init_db, inspector,
-                    item_tags)
-from schemas import ItemCreate, ItemResponse, ItemUpdate
+try:
+    import pyvips
+except (ImportError, OSError):
+    # pyvips is missing or libvips is not installed, use Pillow instead
+    pyvips = None
+
+from models import (Item, SessionLocal, SyncSessionLocal, Tag, engine,
+                    fill_states, init_db, item_tags)
+from schemas import ItemCreate, ItemPage, ItemResponse, ItemUpdate, TagResponse
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    create_fts_search_table()
+    image_lg_dir.mkdir(parents=True, exist_ok=True)
+    image_sm_dir.mkdir(parents=True, exist_ok=True)
+    await run_in_threadpool(setup_database)
     yield
 
 
-app = FastAPI(lifespan=lifespan)
-init_db()
-fill_states()
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
 
 logger = logging.getLogger("uvicorn")
 
-base_dir = Path(__file__).parent.absolute()
+base_dir = Path(__file__).resolve().parent
 static_files_dir = base_dir / "static"
-static_files_dir.mkdir(exist_ok=True)
+image_lg_dir = static_files_dir / "lg"
+image_sm_dir = static_files_dir / "sm"
+
+
+class UploadStaticFiles(StaticFiles):
+    async def get_response(self, path, scope):
+        response = await super().get_response(path, scope)
+        # uploads get a fresh uuid name and are never rewritten in place
+        if path.startswith(("lg/", "sm/")) and response.status_code in (200, 304):
+            response.headers["cache-control"] = "public, max-age=31536000, immutable"
+        return response
+
+
+# the directory is created in lifespan, so don't check for it here
+app.mount(
+    "/static",
+    UploadStaticFiles(directory=str(static_files_dir), check_dir=False),
+    name="static",
+)
+
+# limit concurrent thumbnail jobs to the number of cores
+image_semaphore = asyncio.Semaphore(os.cpu_count() or 1)
+
+# accent folding plus prefix indexes so "term*" searches stay cheap
+fts_options = "tokenize='unicode61 remove_diacritics 2', prefix='2 3 4'"
+
+# jpeg quality for thumbnails, libjpeg would otherwise default to 75
+thumbnail_quality = 85
+
+item_list_adapter = TypeAdapter(List[ItemResponse])
 
-app.mount("/static", StaticFiles(directory=str(static_files_dir)), name="static")
+max_upload_size = 20 * 1024 * 1024
+allowed_extensions = frozenset({".jpg", ".jpeg", ".png", ".webp"})
+# file signature -> suffix the upload is stored under
+image_signatures = {b"\xff\xd8\xff": ".jpg", b"\x89PNG\r\n\x1a\n": ".png"}
+
+
+def is_webp(header: bytes):
+    return header[:4] == b"RIFF" and header[8:12] == b"WEBP"
+
+
+async def check_image(image: UploadFile):
+    # reject oversized or non jpeg/png/webp uploads before anything is written
+    if image.size is not None and image.size > max_upload_size:
+        raise HTTPException(status_code=413, detail="Image too large")
+    header = await image.read(12)
+    await image.seek(0)
+    # the suffix comes from the content, a png sent as x.jpg is stored as .png
+    for signature, suffix in image_signatures.items():
+        if header.startswith(signature):
+            return suffix
+    if is_webp(header):
+        return ".webp"
+    raise HTTPException(status_code=400, detail="Invalid file type")
+
+
+async def save_upload(image: UploadFile):
+    file_extension = Path(image.filename).suffix.casefold()
+    if file_extension not in allowed_extensions:
+        raise HTTPException(status_code=400, detail="Invalid file type")
+    file_extension = await check_image(image)
+    random_filename = f"{uuid.uuid4()}{file_extension}"
+    image_lg_path = image_lg_dir / random_filename
+    output_location = image_sm_dir / random_filename
+    # copy in 1 MiB chunks so memory per upload stays bounded
+    async with aiofiles.open(image_lg_path, "wb") as buffer:
+        while chunk := await image.read(1 << 20):
+            await buffer.write(chunk)
+    return image_lg_path, output_location
 
 
 def resize_image(image_path, output_path, width, height):
+    if pyvips is not None:
+        # libvips shrinks jpegs while decoding, so the full image is never loaded
+        img = pyvips.Image.thumbnail(
+            str(image_path), width, height=height, crop="centre"
+        )
+        # drop exif and other metadata, thumbnails don't need it
+        save_options = {"strip": True}
+        # same lossy quality as the Pillow path below
+        if Path(output_path).suffix.lower() in (".jpg", ".jpeg", ".webp"):
+            save_options["Q"] = thumbnail_quality
+        img.write_to_file(str(output_path), **save_options)
+        return
     with Image.open(image_path) as img:
-        # Resize the image
-        img = img.resize((width, height), Image.LANCZOS)
-        # Save the resized image
-        img.save(output_path)
+        # Let libjpeg decode at a reduced scale before resampling
+        img.draft("RGB", (width * 2, height * 2))
+        # Crop to the target aspect ratio around the centre, like libvips
+        img = ImageOps.fit(img, (width, height), Image.LANCZOS)
+        # Save the resized image, quality only applies to jpegs and webps
+        img.save(output_path, quality=thumbnail_quality)
 
 
-def get_db():
+async def get_db():
     db = SessionLocal()
     try:
         yield db
     finally:
-        db.close()
+        await db.close()
+
+
+def setup_database():
+    # all workers start at once, the lock lets one of them create and seed
+    # the database while the others wait and then find it ready
+    with FileLock(f"{engine.url.database}.lock"):
+        init_db()
+        fill_states()
+        create_fts_search_table()
 
 
 def create_fts_search_table():
-    if "items_fts" not in inspector.get_table_names():
-        create_virtual_tabe_query = text(
-            """
-        CREATE VIRTUAL TABLE items_fts USING fts5(name, comment, tokenize='unicode61')
-        """
-        )
-        populate_with_existing_data = text(
-            """
-        INSERT INTO items_fts(rowid, name, comment)
-        SELECT rowid, name, comment FROM items
+    database = SyncSessionLocal()
+    try:
+        setup_fts_search_table(database)
+    finally:
+        database.close()
+
+
+def setup_fts_search_table(database):
+    # one lookup answers both whether the table exists and how it was built
+    current_ddl = database.execute(
+        text("SELECT sql FROM sqlite_master WHERE type='table' AND name='items_fts'")
+    ).scalar()
+    if current_ddl is not None:
+        if fts_options in current_ddl:
+            return
+        # items_fts predates the current tokenizer, rebuild it from items
+        for trigger in ("items_ai", "items_au", "items_ad"):
+            database.execute(text(f"DROP TRIGGER IF EXISTS {trigger}"))
+        database.execute(text("DROP TABLE items_fts"))
+
+    create_virtual_tabe_query = text(
+        f"CREATE VIRTUAL TABLE items_fts USING fts5(name, comment, {fts_options})"
+    )
+    populate_with_existing_data = text(
         """
-        )
-        # set triggers to update virutal table automatically
-        create_trigger_query = text(
-            """
-        CREATE TRIGGER items_ai AFTER INSERT ON items
-        BEGIN
-          INSERT INTO items_fts(rowid, name, comment) VALUES (new.rowid, new.name, new.comment);
-        END
+    INSERT INTO items_fts(rowid, name, comment)
+    SELECT rowid, name, comment FROM items
+    """
+    )
+    # set triggers to update virutal table automatically
+    create_trigger_query = text(
         """
-        )
-        update_trigger_query = text(
-            """
-        CREATE TRIGGER items_au AFTER UPDATE ON items
-        BEGIN
-          UPDATE items_fts SET name = new.name, comment = new.comment WHERE rowid = new.rowid;
-        END
+    CREATE TRIGGER items_ai AFTER INSERT ON items
+    BEGIN
+      INSERT INTO items_fts(rowid, name, comment) VALUES (new.rowid, new.name, new.comment);
+    END
+    """
+    )
+    update_trigger_query = text(
         """
-        )
-        delete_trigger_query = text(
-            """
-        CREATE TRIGGER items_ad AFTER DELETE ON items
-        BEGIN
-          DELETE FROM items_fts WHERE rowid = old.rowid;
-        END
+    CREATE TRIGGER items_au AFTER UPDATE ON items
+    BEGIN
+      UPDATE items_fts SET name = new.name, comment = new.comment WHERE rowid = new.rowid;
+    END
+    """
+    )
+    delete_trigger_query = text(
         """
-        )
+    CREATE TRIGGER items_ad AFTER DELETE ON items
+    BEGIN
+      DELETE FROM items_fts WHERE rowid = old.rowid;
+    END
+    """
+    )
 
-        database = SessionLocal()
+    try:
+        database.execute(create_virtual_tabe_query)
+        database.execute(populate_with_existing_data)
+        database.execute(create_trigger_query)
+        database.execute(update_trigger_query)
+        database.execute(delete_trigger_query)
+        database.commit()
+    except Exception as e:
+        database.rollback()
+        raise HTTPException(status_code=500, detail=str(e))
 
-        try:
-            database.execute(create_virtual_tabe_query)
-            database.execute(create_trigger_query)
-            database.execute(update_trigger_query)
-            database.execute(delete_trigger_query)
-        except Exception as e:
-            raise HTTPException(status_code=500, detail=str(e))
+
+@app.middleware("http")
+async def add_etag(request: Request, call_next):
+    response = await call_next(request)
+    if (
+        request.method != "GET"
+        or response.status_code != 200
+        or request.url.path.startswith("/static")
+    ):
+        # static files already come with their own etag handling
+        return response
+
+    body = b"".join([chunk async for chunk in response.body_iterator])
+    etag = 'W/"' + hashlib.blake2b(body, digest_size=16).hexdigest() + '"'
+    if_none_match = request.headers.get("if-none-match", "")
+    if etag in (tag.strip() for tag in if_none_match.split(",")):
+        return Response(status_code=304, headers={"etag": etag})
+
+    headers = dict(response.headers)
+    headers["etag"] = etag
+    return Response(
+        content=body,
+        status_code=response.status_code,
+        headers=headers,
+        media_type=response.media_type,
+        background=response.background,
+    )
 
 
 @app.post("/items/", response_model=ItemCreate)
-def create_item(
+async def create_item(
+    background_tasks: BackgroundTasks,
     name: str = Form(...),
     comment: str = Form(None),
     label_id: int = Form(None),
     parent_item_id: int = Form(None),
     image: UploadFile = File(None),
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
 ):
     item_data = {
         "name": name,
@@ -117,155 +270,213 @@ def create_item(
         "label_id": label_id,
         "parent_item_id": parent_item_id,
     }
+    output_location = None
     if image and image.filename:
-        file_extension = Path(image.filename).suffix
-        if file_extension not in [".jpg", ".jpeg", ".png"]:
-            raise HTTPException(status_code=400, detail="Invalid file type")
-        random_filename = f"{uuid.uuid4()}{file_extension}"
-        image_lg_path = static_files_dir / random_filename
-        output_location = static_files_dir / f"resized_{random_filename}"
-        with open(image_lg_path, "wb") as buffer:
-            shutil.copyfileobj(image.file, buffer)
-        try:
-            resize_image(image_lg_path, output_location, 80, 80)
-        except Exception as e:
-            raise HTTPException(status_code=500, detail=str(e))
-
+        image_lg_path, output_location = await save_upload(image)
         item_data["image_lg_path"] = image_lg_path.relative_to(base_dir).as_posix()
-        item_data["image_sm_path"] = output_location.relative_to(base_dir).as_posix()
 
-    db_item = Item(**item_data)
-    db.add(db_item)
+    # RETURNING hands back the server defaults without a refresh query
+    stmt = insert(Item).values(**item_data).returning(Item)
     try:
-        db.commit()
-        db.refresh(db_item)
+        db_item = await db.scalar(stmt)
+        await db.commit()
     except Exception as e:
-        db.rollback()
+        await db.rollback()
+        if output_location is not None:
+            image_lg_path.unlink(missing_ok=True)
         raise HTTPException(status_code=500, detail=str(e))
 
+    get_cached_item.cache_invalidate(db_item.item_id)
+    if output_location is not None:
+        # the thumbnail is created after the response has been sent
+        background_tasks.add_task(
+            run_resize, image_lg_path, output_location, db_item.item_id
+        )
     return db_item
 
 
-# get all items
-@app.get("/items/", response_model=List[ItemResponse])
-def get_all_items(db: Session = Depends(get_db)):
-    items = db.query(Item).all()
-    return items
+async def run_resize(image_path, output_path, item_id):
+    try:
+        async with image_semaphore:
+            await run_in_threadpool(resize_image, image_path, output_path, 80, 80)
+    except Exception:
+        logger.exception("Could not create thumbnail for item %s", item_id)
+        return
+
+    image_lg_path = image_path.relative_to(base_dir).as_posix()
+    image_sm_path = output_path.relative_to(base_dir).as_posix()
+    db = SessionLocal()
+    try:
+        # only set the thumbnail if the item still shows this upload, a newer
+        # image or a deleted item leaves nothing to update
+        result = await db.execute(
+            update(Item)
+            .where(Item.item_id == item_id, Item.image_lg_path == image_lg_path)
+            .values(image_sm_path=image_sm_path)
+        )
+        await db.commit()
+    finally:
+        await db.close()
+    if result.rowcount == 0:
+        output_path.unlink(missing_ok=True)
+        return
+    get_cached_item.cache_invalidate(item_id)
+
+
+# get all items, one page at a time
+@app.get("/items/", response_model=ItemPage)
+async def get_all_items(
+    limit: int = Query(50, ge=1, le=200),
+    cursor: Optional[int] = None,
+    db: AsyncSession = Depends(get_db),
+):
+    stmt = (
+        select(Item)
+        .options(
+            load_only(Item.item_id, Item.name, Item.image_sm_path, Item.parent_item_id),
+            selectinload(Item.tags),
+        )
+        .order_by(Item.item_id)
+        .limit(limit)
+    )
+    if cursor is not None:
+        stmt = stmt.where(Item.item_id > cursor)
+    items = (await db.execute(stmt)).scalars().all()
+    next_cursor = items[-1].item_id if len(items) == limit else None
+    return {"items": items, "next_cursor": next_cursor}
 
 
 # update item
 @app.put("/items/{item_id}", response_model=ItemUpdate)
-def update_item(
+async def update_item(
     item_id: int,
+    background_tasks: BackgroundTasks,
     name: str = Form(None),
     comment: str = Form(None),
     label_id: int = Form(None),
     parent_item_id: int = Form(None),
     image: UploadFile = File(None),
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
 ):
-    db_item = db.query(Item).filter(Item.item_id == item_id).first()
-    if not db_item:
-        raise HTTPException(status_code=404, detail="Item not found")
-
     item_data = {
         "name": name,
         "comment": comment,
         "label_id": label_id,
         "parent_item_id": parent_item_id,
     }
+    output_location = None
     if image and image.filename:
-        file_extension = Path(image.filename).suffix
-        if file_extension not in [".jpg", ".jpeg", ".png"]:
-            raise HTTPException(status_code=400, detail="Invalid file type")
-        random_filename = f"{uuid.uuid4()}{file_extension}"
-        image_lg_path = static_files_dir / random_filename
-        output_location = static_files_dir / f"resized_{random_filename}"
-        with open(image_lg_path, "wb") as buffer:
-            shutil.copyfileobj(image.file, buffer)
-        try:
-            resize_image(image_lg_path, output_location, 80, 80)
-        except Exception as e:
-            raise HTTPException(status_code=500, detail=str(e))
-
+        # don't store an upload for an item that doesn't exist
+        exists = await db.scalar(select(Item.item_id).where(Item.item_id == item_id))
+        if exists is None:
+            raise HTTPException(status_code=404, detail="Item not found")
+        image_lg_path, output_location = await save_upload(image)
         item_data["image_lg_path"] = image_lg_path.relative_to(base_dir).as_posix()
-        item_data["image_sm_path"] = output_location.relative_to(base_dir).as_posix()
 
+    values = {var: value for var, value in item_data.items() if value is not None}
+    if not values:
+        db_item = await db.get(Item, item_id)
+        if db_item is None:
+            raise HTTPException(status_code=404, detail="Item not found")
+        return db_item
+
+    # single UPDATE ... RETURNING instead of loading the row first
+    stmt = update(Item).where(Item.item_id == item_id).values(**values).returning(Item)
+    if logger.isEnabledFor(logging.DEBUG):
+        for var, value in values.items():
+            logger.debug("Updating %s to %s", var, value)
     try:
-        for var, value in item_data.items():
-            if value is not None:
-                print(f"Updating {var} to {value}")
-                setattr(db_item, var, value)
-        db.commit()
-        db.refresh(db_item)
+        db_item = await db.scalar(stmt)
+        await db.commit()
     except Exception as e:
-        db.rollback()
-        print(e)
+        await db.rollback()
+        if output_location is not None:
+            image_lg_path.unlink(missing_ok=True)
         raise HTTPException(status_code=500, detail=str(e))
+    get_cached_item.cache_invalidate(item_id)
+    if db_item is None:
+        # the item was deleted while the upload was being written
+        if output_location is not None:
+            image_lg_path.unlink(missing_ok=True)
+        raise HTTPException(status_code=404, detail="Item not found")
+    if output_location is not None:
+        background_tasks.add_task(run_resize, image_lg_path, output_location, item_id)
     return db_item
 
 
+# short ttl keeps other workers' caches from going stale for long
+@alru_cache(maxsize=4096, ttl=5)
+async def get_cached_item(item_id: int):
+    db = SessionLocal()
+    try:
+        # single row, so the tags can come in with the same query
+        return await db.get(Item, item_id, options=[joinedload(Item.tags)])
+    finally:
+        await db.close()
+
+
 # get item via ID
 @app.get("/items/{item_id}")
-def read_item(item_id: int, db: Session = Depends(get_db)):
-    db_item = db.query(Item).filter(Item.item_id == item_id).first()
+async def read_item(item_id: int):
+    db_item = await get_cached_item(item_id)
     if db_item is None:
         raise HTTPException(status_code=404, detail="Item not found")
     return db_item
 
 
 @app.get("/items/label/{label_id}")
-def get_items_by_label(label_id: int, db: Session = Depends(get_db)):
-    db_item = db.query(Item).filter(Item.label_id == label_id).first()
+async def get_items_by_label(label_id: int, db: AsyncSession = Depends(get_db)):
+    db_item = await db.scalar(select(Item).where(Item.label_id == label_id))
     if db_item is None:
         raise HTTPException(status_code=404, detail="Item not found")
     return db_item
 
 
 # get item children
-@app.get("/items/children_v2/{item_id}", response_model=List[ItemResponse])
-def get_item_children_v2(item_id: int, db: Session = Depends(get_db)):
+@app.get("/items/children/{item_id}", response_model=List[ItemResponse])
+async def get_item_children(item_id: int, db: AsyncSession = Depends(get_db)):
     child_alias = aliased(Item)
+
+    # Count each row's children with a correlated subquery, which is an index
+    # lookup on parent_item_id instead of grouping a join over the table
     children_count = (
-        db.query(func.count(child_alias.item_id))
-        .filter(child_alias.parent_item_id == Item.item_id)
-        .scalar()
+        select(func.count(child_alias.item_id))
+        .where(child_alias.parent_item_id == Item.item_id)
+        .correlate(Item)
+        .scalar_subquery()
     )
-    # has_children = exists().where(child_alias.parent_item_id == Item.item_id).label("has_children")
-    children_query = db.query(Item, children_count)
-    if item_id is None or item_id == 0:
-        children = children_query.filter(Item.parent_item_id == None).all()
-    else:
-        children = children_query.filter(Item.parent_item_id == item_id).all()
-    if not children:
-        raise HTTPException(status_code=404, detail="No children found for this item")
-    children = add_has_children_field(children)
-    return children
-
-
-@app.get("/items/children/{item_id}", response_model=List[ItemResponse])
-def get_item_children(item_id: int, db: Session = Depends(get_db)):
-    child_alias = aliased(Item)
 
     # This query fetches items along with their children count
-    children_query = (
-        db.query(Item, func.count(child_alias.item_id).label("children_count"))
-        .outerjoin(child_alias, child_alias.parent_item_id == Item.item_id)
-        .group_by(Item.item_id)
+    children_query = select(Item, children_count.label("children_count")).options(
+        # only the columns ItemResponse serializes
+        load_only(
+            Item.item_id,
+            Item.name,
+            Item.comment,
+            Item.label_id,
+            Item.parent_item_id,
+            Item.image_lg_path,
+            Item.image_sm_path,
+            Item.creation_date,
+            Item.last_update,
+        ),
+        selectinload(Item.tags),
     )
 
     if item_id is None or item_id == 0:
-        children = children_query.filter(Item.parent_item_id == None).all()
+        children_query = children_query.where(Item.parent_item_id == None)
     else:
-        children = children_query.filter(Item.parent_item_id == item_id).all()
+        children_query = children_query.where(Item.parent_item_id == item_id)
+    children = (await db.execute(children_query)).all()
 
     if not children:
         raise HTTPException(status_code=404, detail="No children found for this item")
 
-    # Map the result to the Pydantic model
+    # Map the result to the Pydantic model, the rows come straight from the
+    # database so validation is skipped
     response_list = []
     for item, children_count in children:
-        response_item = ItemResponse(
+        response_item = ItemResponse.model_construct(
             item_id=item.item_id,
             name=item.name,
             comment=item.comment,
@@ -276,85 +487,103 @@ def get_item_children(item_id: int, db: Session = Depends(get_db)):
             creation_date=item.creation_date,
             last_update=item.last_update,
             children_count=children_count,  # Set children_count here
-            tags=[],  # Assuming Tag model has a 'name' field
+            tags=[
+                TagResponse.model_construct(tag_id=tag.tag_id, tag_name=tag.tag_name)
+                for tag in item.tags
+            ],
         )
         response_list.append(response_item)
 
-    return response_list
+    # returning a response directly also skips FastAPI's response_model check
+    return ORJSONResponse(item_list_adapter.dump_python(response_list, mode="json"))
 
 
 @app.delete("/items/{item_id}")
-def delete_item(item_id: int, db: Session = Depends(get_db)):
-    db_item = db.query(Item).filter(Item.item_id == item_id).first()
+async def delete_item(item_id: int, db: AsyncSession = Depends(get_db)):
+    db_item = await db.get(Item, item_id)
     if db_item is None:
         raise HTTPException(status_code=404, detail="Item not found")
-    db.delete(db_item)
-    db.commit()
+    await db.delete(db_item)
+    await db.commit()
+    get_cached_item.cache_invalidate(item_id)
     return db_item
 
 
-@app.get("/items/{tag_name}")
-def get_items_by_tag(tag_name: str, db: Session = Depends(get_db)):
-    items = db.query(Item).join(Item.tags).filter(Tag.tag_name == tag_name).all()
+@app.get("/items/by-tag/{tag_name}")
+async def get_items_by_tag(tag_name: str, db: AsyncSession = Depends(get_db)):
+    # filter by the matching item ids instead of joining, so items are not
+    # repeated per association and tags are loaded in one batch
+    tagged_item_ids = (
+        select(item_tags.c.item_id)
+        .join(Tag, Tag.tag_id == item_tags.c.tag_id)
+        .where(Tag.tag_name == tag_name)
+    )
+    stmt = (
+        select(Item)
+        .where(Item.item_id.in_(tagged_item_ids))
+        .options(selectinload(Item.tags))
+    )
+    items = (await db.execute(stmt)).scalars().all()
     if not items:
         raise HTTPException(status_code=404, detail="Item not found")
     return items
 
 
 @app.post("/tags/")
-def create_tag(tag_name: str, db: Session = Depends(get_db)):
-    db_tag = Tag(tag_name=tag_name)
-    db.add(db_tag)
-    db.commit()
-    db.refresh(db_tag)
+async def create_tag(tag_name: str, db: AsyncSession = Depends(get_db)):
+    stmt = insert(Tag).values(tag_name=tag_name).returning(Tag)
+    try:
+        db_tag = await db.scalar(stmt)
+        await db.commit()
+    except IntegrityError:
+        await db.rollback()
+        raise HTTPException(status_code=409, detail="Tag already exists")
     return db_tag
 
 
 @app.delete("/tags/{tag_id}")
-def delete_tag(tag_id: int, db: Session = Depends(get_db)):
+async def delete_tag(tag_id: int, db: AsyncSession = Depends(get_db)):
     # Delete associations in item_tags junction table
-    db.query(item_tags).filter(item_tags.c.tag_id == tag_id).delete(
-        synchronize_session=False
-    )
+    await db.execute(delete(item_tags).where(item_tags.c.tag_id == tag_id))
 
-    # Delete the tag itself
-    db_tag = db.query(Tag).filter(Tag.tag_id == tag_id).first()
-    if db_tag is None:
+    # Delete the tag itself, both deletes are committed together
+    result = await db.execute(delete(Tag).where(Tag.tag_id == tag_id))
+    if not result.rowcount:
+        await db.rollback()
         raise HTTPException(status_code=404, detail="Tag not found")
-    db.delete(db_tag)
-    db.commit()
+    await db.commit()
+    # cached items carry their tags
+    get_cached_item.cache_clear()
     return {"detail": "Tag deleted"}
 
 
 @app.get("/search/")
-def search_items(query: str, db: Session = Depends(get_db)):
+async def search_items(
+    query: str,
+    limit: int = Query(50, ge=1, le=200),
+    db: AsyncSession = Depends(get_db),
+):
     if query is None:
         raise HTTPException(status_code=400, detail="Query parameter is required")
     if query.strip() == "":
         raise HTTPException(status_code=400, detail="Query parameter cannot be empty")
     query = query.lower()
     modified_query = query + "*"
+    # bm25() is lower for better matches, so rank ascending. Ranking and
+    # limiting inside the CTE keeps the MATCH on the fts index.
     sql_query = text(
-        "SELECT i.* "
-        "FROM items as i "
-        "INNER JOIN items_fts ON i.rowid = items_fts.rowid "
+        "WITH fts AS ("
+        "SELECT rowid, bm25(items_fts) AS score "
+        "FROM items_fts "
         "WHERE items_fts MATCH :query "
-        "ORDER BY bm25(items_fts) DESC"
+        "ORDER BY score "
+        "LIMIT :limit"
+        ") "
+        "SELECT i.* "
+        "FROM fts "
+        "INNER JOIN items as i ON i.rowid = fts.rowid "
+        "ORDER BY fts.score"
     )
-    results = db.execute(sql_query, {"query": modified_query})
+    results = await db.execute(sql_query, {"query": modified_query, "limit": limit})
     items = results.mappings().all()
     return items
-
-
-def add_has_children_field(result_list):
-    if len(result_list[0]) != 2:
-        raise HTTPException(
-            status_code=500, detail="Database returns not ITEM, has_children"
-        )
-    new_items = []
-    for item_and_children in result_list:
-        item = item_and_children[0]
-        children_count = item_and_children[1]
-        item.children_count = children_count
-        new_items.append(item)
-    return new_items
@@ -1,27 +1,74 @@
-from sqlalchemy import Column, Integer, String, create_engine, Table, ForeignKey, DateTime, func, Boolean, inspect
+import logging
+
+from sqlalchemy import Column, Integer, String, create_engine, Table, ForeignKey, DateTime, func, Boolean, event, Index, text
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, relationship
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+
+logger = logging.getLogger("uvicorn")
 
 SQLALCHEMY_DATABASE_URL = "sqlite:///./home_inventory.db"
-engine = create_engine(SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False})
-inspector = inspect(engine)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+ASYNC_SQLALCHEMY_DATABASE_URL = "sqlite+aiosqlite:///./home_inventory.db"
+IS_SQLITE = SQLALCHEMY_DATABASE_URL.startswith("sqlite")
+connect_args = {"check_same_thread": False} if IS_SQLITE else {}
+
+# sync engine is only used for schema setup and seeding at startup
+engine = create_engine(SQLALCHEMY_DATABASE_URL, connect_args=connect_args, pool_pre_ping=True)
+SyncSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+# aiosqlite defaults to NullPool, so the queue pool has to be requested explicitly
+async_engine = create_async_engine(
+    ASYNC_SQLALCHEMY_DATABASE_URL,
+    poolclass=AsyncAdaptedQueuePool,
+    pool_size=30,
+    max_overflow=20,
+    pool_recycle=3600,
+    pool_pre_ping=True,
+)
+SessionLocal = async_sessionmaker(
+    bind=async_engine, autocommit=False, autoflush=False, expire_on_commit=False
+)
+
+
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    # WAL lets readers run while a write is in progress
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA cache_size=-65536")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.execute("PRAGMA mmap_size=268435456")
+    # foreign_keys stays off: items reference label ids that have no row in
+    # labels, enforcing the constraint would reject them
+    cursor.close()
+
+
+if IS_SQLITE:
+    event.listen(engine, "connect", set_sqlite_pragmas)
+    event.listen(async_engine.sync_engine, "connect", set_sqlite_pragmas)
+
 Base = declarative_base()
 
 item_tags = Table('item_tags', Base.metadata,
     Column('item_id', ForeignKey('items.item_id'), primary_key=True),
     Column('tag_id', ForeignKey('tags.tag_id'), primary_key=True)
 )
+# the primary key already covers lookups by item_id, this one serves tag_id
+# and lets tag -> item_id lookups be answered from the index alone
+Index('ix_item_tags_tag_item', item_tags.c.tag_id, item_tags.c.item_id)
 
 
 class Item(Base):
     __tablename__ = "items"
 
     item_id = Column(Integer, primary_key=True, index=True)
-    label_id = Column(Integer, ForeignKey('labels.label_id'))
-    parent_item_id = Column(Integer, ForeignKey('items.item_id'))
+    label_id = Column(Integer, ForeignKey('labels.label_id'), index=True)
+    parent_item_id = Column(Integer, ForeignKey('items.item_id'), index=True)
     name = Column(String, nullable=False)
-    state = Column(Integer, ForeignKey('states.state_id'))
+    state = Column(Integer, ForeignKey('states.state_id'), index=True)
     comment = Column(String)
     image_lg_path = Column(String)
     image_sm_path = Column(String)
@@ -40,14 +87,14 @@ class State(Base):
     __tablename__ = "states"
 
     state_id = Column(Integer, primary_key=True, index=True)
-    state_name = Column(String)
+    state_name = Column(String, unique=True, index=True, nullable=False)
 
 
 class Tag(Base):
     __tablename__ = "tags"
 
     tag_id = Column(Integer, primary_key=True, index=True)
-    tag_name = Column(String)
+    tag_name = Column(String, unique=True, index=True)
     items = relationship("Item", secondary=item_tags, back_populates="tags")
 
 
@@ -61,27 +108,57 @@ class Event(Base):
     __tablename__ = "events"
     event_id = Column(Integer, primary_key=True, index=True)
     event_date = Column(DateTime(timezone=True), server_default=func.now())
-    item_id = Column(Integer, ForeignKey('items.item_id'))
-    to_state = Column(Integer, ForeignKey('states.state_id'))
-    parent_item_id = Column(Integer, ForeignKey('items.item_id'))
+    item_id = Column(Integer, ForeignKey('items.item_id'), index=True)
+    to_state = Column(Integer, ForeignKey('states.state_id'), index=True)
+    parent_item_id = Column(Integer, ForeignKey('items.item_id'), index=True)
+
+
+# states that share their name with a lower state_id
+DUPLICATE_STATES = (
+    "SELECT state_id FROM states WHERE state_name IS NOT NULL AND state_id NOT IN "
+    "(SELECT MIN(state_id) FROM states GROUP BY state_name)"
+)
+FIRST_STATE = (
+    "SELECT MIN(k.state_id) FROM states s JOIN states k ON k.state_name = s.state_name "
+    "WHERE s.state_id = {column}"
+)
+
+
+def merge_duplicate_states(connection):
+    # the seeding used to check and insert in every worker at once, so older
+    # databases can hold a state more than once. Point items and events at
+    # the first copy and drop the rest, otherwise the unique state_name index
+    # can't be created and fill_states has nothing to conflict with
+    for table, column in (("items", "state"), ("events", "to_state")):
+        first = FIRST_STATE.format(column=f"{table}.{column}")
+        connection.execute(text(
+            f"UPDATE {table} SET {column} = ({first}) WHERE {column} IN ({DUPLICATE_STATES})"
+        ))
+    connection.execute(text(f"DELETE FROM states WHERE state_id IN ({DUPLICATE_STATES})"))
 
 
 def init_db():
     Base.metadata.create_all(bind=engine)
+    with engine.begin() as connection:
+        merge_duplicate_states(connection)
+    # create_all skips tables that already exist, so add indexes declared
+    # since then to older databases
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            try:
+                index.create(bind=engine, checkfirst=True)
+            except IntegrityError as e:
+                # e.g. duplicate tag names block the unique tag_name index
+                logger.warning("Could not create index %s: %s", index.name, e)
 
 def fill_states():
-    session = SessionLocal()
+    session = SyncSessionLocal()
     initial_states = [
         {"state_name": "stored"},
         {"state_name": "not stored"},
     ]
-    for state_data in initial_states:
-        # Check if the state already exists
-        existing_state = session.query(State).filter_by(state_name=state_data["state_name"]).first()
-        if not existing_state:
-            # State does not exist, so add it
-            state = State(**state_data)
-            session.add(state)
-
+    # One statement for all states, rows that already exist are skipped
+    # through the unique state_name index
+    session.execute(insert(State).values(initial_states).on_conflict_do_nothing())
     session.commit()
     session.close()
@@ -1,8 +1,10 @@
-from pydantic import BaseModel
-from typing import Optional
+from pydantic import BaseModel, ConfigDict
+from typing import List, Optional
 from datetime import datetime
 
 class ItemCreate(BaseModel):
+    model_config = ConfigDict(from_attributes=True)
+
     name: str
     comment: Optional[str] = None
     label_id: Optional[int] = None
@@ -11,13 +13,23 @@ class ItemCreate(BaseModel):
     image_sm_path: Optional[str] = None
 
 class ItemUpdate(BaseModel):
+    model_config = ConfigDict(from_attributes=True)
+
     name: Optional[str] = None
     comment: Optional[str] = None
     label_id: Optional[int] = None
     parent_item_id: Optional[int] = None
     image_path: Optional[str] = None
 
+class TagResponse(BaseModel):
+    model_config = ConfigDict(from_attributes=True)
+
+    tag_id: int
+    tag_name: Optional[str]
+
 class ItemResponse(BaseModel):
+    model_config = ConfigDict(from_attributes=True)
+
     item_id: int
     name: str
     comment: Optional[str]
@@ -27,5 +39,18 @@ class ItemResponse(BaseModel):
     image_sm_path: Optional[str]
     creation_date: datetime
     last_update: Optional[datetime]
-    children_count: Optional[int]
-    tags: Optional[list]
+    children_count: Optional[int] = None
+    tags: Optional[List[TagResponse]] = None
+
+class ItemSummary(BaseModel):
+    model_config = ConfigDict(from_attributes=True)
+
+    item_id: int
+    name: str
+    parent_item_id: Optional[int]
+    image_sm_path: Optional[str]
+    tags: Optional[List[TagResponse]] = None
+
+class ItemPage(BaseModel):
+    items: List[ItemSummary]
+    next_cursor: Optional[int] = None
@@ -0,0 +1,15 @@
+import os
+
+import uvicorn
+
+if __name__ == "__main__":
+    uvicorn.run(
+        "main:app",
+        host=os.environ.get("HOST", "0.0.0.0"),
+        port=int(os.environ.get("PORT", 8000)),
+        loop="uvloop",
+        http="httptools",
+        workers=os.cpu_count(),
+        backlog=2048,
+        limit_concurrency=1000,
+    )